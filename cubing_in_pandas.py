@@ -7,9 +7,14 @@ A quick and dirty way to support CUBE and ROLLUP in Python pandas.
 Released under MIT License.
 """
 
+import os
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, combinations
+
 import pandas as pd
 import numpy as np
-from itertools import combinations
 
 
 def _cols_normalize(cols=None):
@@ -23,40 +28,483 @@ def _cols_normalize(cols=None):
 def _check_no_interleaving_cols(normal_cols=None,
                             cube_cols=None,
                             rollup_cols=None):
-    normal_cols = set(_cols_normalize(normal_cols))
-    cube_cols = set(_cols_normalize(cube_cols))
-    rollup_cols = set(_cols_normalize(rollup_cols))
+    all_cols = (list(_cols_normalize(normal_cols)) +
+                list(_cols_normalize(cube_cols)) +
+                list(_cols_normalize(rollup_cols)))
 
-    all_cols = (normal_cols | cube_cols | rollup_cols)
+    return len(all_cols) == len(set(all_cols))
 
-    all_lengths = (len(normal_cols) + len(cube_cols) + len(rollup_cols))
 
-    return len(all_cols) == all_lengths
+def _get_cube_combinations(x):
+    return list(
+        chain.from_iterable(
+            combinations(x, comb_len) for comb_len in range(len(x) + 1)))
 
 
-def _get_cube_combinations(x):
-    res = []
-    for comb_len in range(len(x) + 1):
-        for comb in combinations(x, comb_len):
-            res.append(comb)
+def _get_rollup_combinations(x):
+    return [tuple(x[:i]) for i in range(len(x) + 1)]
+
+
+def _get_group_ids(key_codes, n_rows):
+    """
+    Combine the factorized codes of the keys into dense group ids.
+
+    NaN (code -1) is kept as a group of its own.
+    Return the group ids of the rows, the position of the first row
+    of each group and the number of groups.
+    """
+    if not key_codes:
+        # all the dimensions are folded, there is only one group
+        return np.zeros(n_rows, dtype=np.intp), [0], 1
+
+    comb_codes = np.zeros(n_rows, dtype=np.int64)
+    comb_size = 1
+    for codes, n_uniques in key_codes:
+        # shift NaN (code -1) to the code 0
+        n_uniques += 1
+        if comb_size * n_uniques >= 2**62:
+            # densify the combined codes before they could overflow
+            _, comb_codes = np.unique(comb_codes, return_inverse=True)
+            comb_size = n_rows
+        comb_codes = comb_codes * n_uniques + (codes + 1)
+        comb_size *= n_uniques
+
+    uniques, first, ids = np.unique(comb_codes,
+                                    return_index=True,
+                                    return_inverse=True)
+    return ids, first, len(uniques)
+
+
+def _group_sum(ids, values, n_groups):
+    if values.dtype.kind == 'f':
+        # skip NaN like pandas sum
+        values = np.where(np.isnan(values), 0, values)
+        # bincount always sums in float64, keep e.g. float32 like pandas
+        return np.bincount(ids, weights=values,
+                           minlength=n_groups).astype(values.dtype,
+                                                      copy=False)
+    res = np.zeros(n_groups,
+                   dtype=np.uint64 if values.dtype.kind == 'u' else np.int64)
+    np.add.at(res, ids, values)
     return res
 
 
-def _get_rollup_combinations(x):
-    res = []
-    for i in range(len(x) + 1):
-        comb = tuple(x[:i])
-        res.append(comb)
+def _group_extremum(ids, values, n_groups, func, int_initial):
+    if values.dtype.kind == 'f':
+        # fmin and fmax skip NaN, and all NaN groups stay NaN
+        res = np.full(n_groups, np.nan, dtype=values.dtype)
+        func = {np.minimum: np.fmin, np.maximum: np.fmax}[func]
+    else:
+        res = np.full(n_groups, int_initial, dtype=values.dtype)
+    func.at(res, ids, values)
     return res
 
 
+def _group_min(ids, values, n_groups):
+    int_initial = None
+    if values.dtype.kind != 'f':
+        int_initial = np.iinfo(values.dtype).max
+    return _group_extremum(ids, values, n_groups, np.minimum, int_initial)
+
+
+def _group_max(ids, values, n_groups):
+    int_initial = None
+    if values.dtype.kind != 'f':
+        int_initial = np.iinfo(values.dtype).min
+    return _group_extremum(ids, values, n_groups, np.maximum, int_initial)
+
+
+def _get_unique_pairs(ids, value_codes, n_values):
+    """
+    The distinct (group id, value code) pairs, which are the part of nunique.
+
+    NaN values (code -1) are skipped like nunique.
+    """
+    valid = value_codes >= 0
+    pairs = np.unique(ids[valid].astype(np.int64) * n_values +
+                      value_codes[valid])
+    return pairs // n_values, pairs % n_values, n_values
+
+
+def _group_union(ids, values, n_groups):
+    pair_ids, value_codes, n_values = values
+    return _get_unique_pairs(ids[pair_ids], value_codes, n_values)
+
+
+# the vectorized kernels to combine the parts, by the group ids
+_GROUP_REDUCERS = {
+    'sum': _group_sum,
+    'min': _group_min,
+    'max': _group_max,
+    'union': _group_union,
+}
+
+# aggregations that can be computed on the finest grouping first,
+# and then be re-aggregated to any coarser grouping.
+# each one is a list of (base_func, combine_func) parts.
+_DECOMPOSABLE_AGGS = {
+    'sum': [('sum', 'sum')],
+    'min': [('min', 'min')],
+    'max': [('max', 'max')],
+    'count': [('count', 'sum')],
+    'mean': [('sum', 'sum'), ('count', 'sum')],
+    # the part of unique is not computed by pandas, see _get_unique_pairs
+    'nunique': [('unique', 'union')],
+}
+
+# the equivalent str of some callables,
+# so that pandas does not call them group by group in Python
+_AGG_ALIASES = {
+    pd.Series.sum: 'sum',
+    pd.Series.min: 'min',
+    pd.Series.max: 'max',
+    pd.Series.count: 'count',
+    pd.Series.mean: 'mean',
+    pd.Series.nunique: 'nunique',
+}
+
+
+def _get_decomposed_agg(df, agg):
+    base_agg = {}
+    combine_agg = {}
+    for col, func in agg.items():
+        if not isinstance(func, str) or func not in _DECOMPOSABLE_AGGS:
+            return None
+        # only plain numpy numbers can be combined by the kernels,
+        # and e.g., summing strings is not associative in the order of rows
+        dtype = df[col].dtype
+        if func != 'nunique' and (not isinstance(dtype, np.dtype)
+                                  or dtype.kind not in 'iuf'):
+            return None
+        parts = _DECOMPOSABLE_AGGS[func]
+        if func != 'nunique':
+            base_agg[col] = [base_func for base_func, _ in parts]
+        for base_func, combine_func in parts:
+            combine_agg[(col, base_func)] = combine_func
+    return base_agg, combine_agg
+
+
+def _reaggregate(parent, n_uniques, groupby_positions, combine_agg):
+    """
+    Re-aggregate the parts of a grouping set (or the base) to a subset of it.
+
+    A grouping set is (the codes of each key position, the parts, the number
+    of rows). The NaN keys (code -1) are kept as groups here,
+    because the subsets would still need the rows of them.
+    """
+    parent_codes, parent_parts, n_parent = parent
+    ids, first, n_groups = _get_group_ids(
+        [(parent_codes[i], n_uniques[i]) for i in groupby_positions],
+        n_parent)
+
+    codes = {i: parent_codes[i][first] for i in groupby_positions}
+    parts = {
+        part: _GROUP_REDUCERS[combine_func](ids, parent_parts[part], n_groups)
+        for part, combine_func in combine_agg.items()
+    }
+    return codes, parts, n_groups
+
+
+def _finalize_grouping_set(grouping_set, agg):
+    """
+    Drop the NaN keys of a re-aggregated grouping set,
+    and compute the aggregations from the parts.
+
+    The keys are returned as codes, to be mapped back to the values
+    only once in the "UNION ALL".
+    """
+    codes, parts, n_rows = grouping_set
+
+    res = dict(codes)
+    for col, func in agg.items():
+        if func == 'mean':
+            sums = parts[(col, 'sum')]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                # divided by the int64 count, keep e.g. float32 like pandas
+                res[col] = (sums / parts[(col, 'count')]).astype(sums.dtype,
+                                                                 copy=False)
+        elif func == 'nunique':
+            pair_ids, _, _ = parts[(col, 'unique')]
+            res[col] = np.bincount(pair_ids, minlength=n_rows)
+        else:
+            res[col] = parts[(col, _DECOMPOSABLE_AGGS[func][0][0])]
+
+    valid = np.ones(n_rows, dtype=bool)
+    for x in codes.values():
+        valid &= x >= 0
+    if not valid.all():
+        res = {x: values[valid] for x, values in res.items()}
+        n_rows = int(valid.sum())
+
+    return n_rows, res
+
+
 def _get_grouping_filling(col_name, filling=None):
-    if filling is None:
-        return None
-    try:
+    # a dict (or anything with get) for each column,
+    # otherwise the same value for all the columns
+    if hasattr(filling, 'get'):
         return filling.get(col_name, None)
-    except:
-        return filling
+    return filling
+
+
+def _get_filling_dtype(dim_value_to_fill, original_dtype):
+    if pd.api.types.is_integer_dtype(
+            original_dtype) and dim_value_to_fill is None:
+        # for integer and None, we need special treatment
+        if isinstance(original_dtype, pd.api.extensions.ExtensionDtype):
+            # keep the nullable integers nullable
+            return pd.Float64Dtype()
+        return np.float64
+    # directly use the original dtype if not integer and not None
+    return original_dtype
+
+
+def _get_filled_values(dim_value_to_fill, fill_dtype, n_rows):
+    """
+    An array of n_rows of the filling, in the dtype of the filling.
+    """
+    fill_dtype = pd.api.types.pandas_dtype(fill_dtype)
+    if isinstance(fill_dtype, np.dtype):
+        # one C-level fill, instead of boxing a list of n_rows objects
+        return np.full(n_rows, dim_value_to_fill, dtype=fill_dtype)
+    return pd.array([dim_value_to_fill] * n_rows, dtype=fill_dtype)
+
+
+def _get_sort_codes(codes, uniques, dim_value_to_fill, fill_dtype):
+    """
+    Map the codes to the ranks of their values, for sorting the result.
+
+    The folded ones (code -1) are ranked by the filling,
+    as it is in the column after being converted to fill_dtype,
+    and NaN is ranked last like in sort_values.
+    """
+    filling = _get_filled_values(dim_value_to_fill, fill_dtype, 1)
+    values = uniques.append(pd.Index(filling))
+    ranks, sorted_values = pd.factorize(values, sort=True)
+    ranks = np.where(ranks < 0, len(sorted_values), ranks)
+    # the code -1 picks the last rank, which is the filling
+    return ranks[codes]
+
+
+def _decode_codes(codes, uniques, dim_value_to_fill, fill_dtype):
+    """
+    Map the codes back to the values, filling the folded ones (code -1).
+    """
+    not_folded = codes >= 0
+    if not_folded.all():
+        # e.g., the normal cols are never folded
+        return pd.Series(uniques.take(codes))
+    values = _get_filled_values(dim_value_to_fill, fill_dtype, len(codes))
+    values[not_folded] = uniques.take(codes[not_folded])
+    return pd.Series(values, dtype=values.dtype)
+
+
+def _cubinggroupby_core(df, normal_cols, cube_cols, rollup_cols, agg,
+                        map_func):
+    """
+    Aggregate all the grouping sets, before they are filled and unioned.
+
+    The independent grouping sets are aggregated with map_func,
+    which is either map or the map of a thread pool.
+
+    Return a list of (number of rows, columns) for each grouping set,
+    and the uniques of the keys that are returned as codes.
+    """
+    all_groupby_cols = normal_cols + cube_cols + rollup_cols
+    value_cols = list(agg.keys())
+
+    cube_combs = _get_cube_combinations(cube_cols)
+    rollup_combs = _get_rollup_combinations(rollup_cols)
+
+    fill_dtypes = {x: df[x].dtype for x in all_groupby_cols}
+
+    # group by on integer codes of categories is much faster than on strings,
+    # the original dtypes are restored after the "UNION ALL"
+    categorical_cols = [
+        x for x in all_groupby_cols
+        if pd.api.types.is_object_dtype(fill_dtypes[x])
+        or pd.api.types.is_string_dtype(fill_dtypes[x])
+    ]
+    df = df.astype({x: 'category' for x in categorical_cols})
+
+    # the keys with known uniques (in the original dtypes)
+    # are kept as codes until the "UNION ALL"
+    key_uniques = {
+        x: df[x].cat.categories.astype(fill_dtypes[x])
+        for x in categorical_cols
+    }
+
+    decomposed_agg = None
+    if all_groupby_cols:
+        decomposed_agg = _get_decomposed_agg(df, agg)
+    if decomposed_agg is not None:
+        base_agg, combine_agg = decomposed_agg
+        # group by all the columns only once,
+        # the coarser groupings are derived from this much smaller result.
+        # the sum of an integer mean would wrap around in int64,
+        # accumulate it in float64 like the mean of pandas
+        float_mean_cols = {
+            x: np.float64
+            for x, func in agg.items()
+            if func == 'mean' and df[x].dtype.kind in 'iu'
+        }
+        if float_mean_cols:
+            df = df.astype(float_mean_cols)
+        grouped = df.groupby(all_groupby_cols,
+                             dropna=False,
+                             observed=True,
+                             sort=False)
+        if base_agg:
+            base = grouped.agg(base_agg)
+        else:
+            # e.g., only nunique, but the keys are still needed
+            base = grouped.size().to_frame()
+        # the group by has already factorized the keys in the MultiIndex,
+        # keep them as one contiguous column of int32 codes for each key
+        base_index = base.index
+        if not isinstance(base_index, pd.MultiIndex):
+            base_index = pd.MultiIndex.from_arrays([base_index])
+        base_codes = np.empty((len(base), len(all_groupby_cols)),
+                              dtype=np.int32,
+                              order='F')
+        base_n_uniques = []
+        for i, x in enumerate(all_groupby_cols):
+            codes = base_index.codes[i]
+            uniques = base_index.levels[i]
+            # NaN is a level with dropna=False,
+            # but it should be dropped in the grouping sets
+            is_nan_level = pd.isnull(uniques)
+            if is_nan_level.any():
+                codes = np.where((codes < 0) | is_nan_level[codes], -1, codes)
+            base_codes[:, i] = codes
+            base_n_uniques.append(len(uniques))
+            if uniques.dtype != fill_dtypes[x]:
+                uniques = uniques.astype(fill_dtypes[x])
+            key_uniques[x] = uniques
+        base_values = {}
+        for part in combine_agg:
+            col, base_func = part
+            if base_func == 'unique':
+                value_codes, value_uniques = pd.factorize(df[col])
+                base_values[part] = _get_unique_pairs(
+                    grouped.ngroup().to_numpy(), value_codes,
+                    max(len(value_uniques), 1))
+            else:
+                base_values[part] = base[part].to_numpy()
+        groupby_positions = {x: i for i, x in enumerate(all_groupby_cols)}
+        base_grouping_set = ({i: base_codes[:, i]
+                              for i in range(len(all_groupby_cols))},
+                             base_values, len(base))
+
+    all_folded_key = np.zeros(len(df), dtype=np.int8)
+
+    def _aggregate_grouping_set(groupby_cols):
+        #print(groupby_cols)
+        #print(agg)
+        # if all dimensions are folded, group by a constant key,
+        # so that it is aggregated like any other grouping set
+        single_result = df.groupby(groupby_cols or all_folded_key,
+                                   observed=True,
+                                   sort=False).agg(agg).reset_index(
+                                       drop=not groupby_cols)
+
+        # only keep the columns that are not folded,
+        # the folded ones are filled right in the "UNION ALL"
+        return len(single_result), {
+            x: single_result[x].cat.codes.to_numpy()
+            if x in key_uniques else single_result[x]
+            for x in groupby_cols + value_cols
+        }
+
+    grouping_sets = [
+        normal_cols + list(cube_single_comb + rollup_single_comb)
+        for cube_single_comb in cube_combs
+        for rollup_single_comb in rollup_combs
+    ]
+
+    def _reaggregate_grouping_set(groupby_cols):
+        positions = [groupby_positions[x] for x in groupby_cols]
+        positions_set = frozenset(positions)
+        if len(positions_set) == len(all_groupby_cols):
+            # the finest grouping set is the base itself
+            grouping_set = base_grouping_set
+        else:
+            # the smallest one of the supersets in the previous level,
+            # there is always one, e.g., with one more cube col or rollup col
+            parent = min((parent_sets[x] for x in parent_sets
+                          if positions_set <= x),
+                         key=lambda x: x[2])
+            grouping_set = _reaggregate(parent, base_n_uniques, positions,
+                                        combine_agg)
+        n_groups, single_result = _finalize_grouping_set(grouping_set, agg)
+        for x in groupby_cols:
+            single_result[x] = single_result.pop(groupby_positions[x])
+        return positions_set, grouping_set, (n_groups, single_result)
+
+    # the grouping sets (of the same size) are independent
+    if decomposed_agg is None:
+        comb_results = list(map_func(_aggregate_grouping_set, grouping_sets))
+    else:
+        # from the largest grouping sets to the smallest ones,
+        # each one is re-aggregated from its smallest superset
+        # of one more column, instead of from the base every time.
+        # only the previous level is kept, to release the larger ones
+        parent_sets = {}
+        comb_results = [None] * len(grouping_sets)
+        # the positions of the grouping sets of each size, in one pass
+        levels = {}
+        for i, x in enumerate(grouping_sets):
+            levels.setdefault(len(x), []).append(i)
+        for size in sorted(levels, reverse=True):
+            level = levels[size]
+            level_results = list(
+                map_func(_reaggregate_grouping_set,
+                         [grouping_sets[i] for i in level]))
+            parent_sets = {}
+            for i, (positions, grouping_set,
+                    single_result) in zip(level, level_results):
+                parent_sets[positions] = grouping_set
+                comb_results[i] = single_result
+
+    return comb_results, key_uniques
+
+
+# the results of _cubinggroupby_core, from the key of the call
+# to (a weak reference to df, the results), least recently used first.
+# the entries are dropped as soon as their df is freed
+_CORE_CACHE = OrderedDict()
+_CORE_CACHE_SIZE = 8
+
+
+def _cubinggroupby_core_cached(df, normal_cols, cube_cols, rollup_cols, agg,
+                               map_func):
+    try:
+        key = (id(df), df.shape, tuple(df.columns),
+               tuple(str(x) for x in df.dtypes), tuple(normal_cols),
+               tuple(cube_cols), tuple(rollup_cols), tuple(agg.items()))
+        hash(key)
+    except TypeError:
+        # e.g., a list of aggregation functions
+        return _cubinggroupby_core(df, normal_cols, cube_cols, rollup_cols,
+                                   agg, map_func)
+
+    cached = _CORE_CACHE.get(key)
+    # the id may have been reused by another df
+    if cached is not None and cached[0]() is df:
+        _CORE_CACHE.move_to_end(key)
+    else:
+        cached = (weakref.ref(df),
+                  _cubinggroupby_core(df, normal_cols, cube_cols, rollup_cols,
+                                      agg, map_func))
+        _CORE_CACHE[key] = cached
+        weakref.finalize(df, _CORE_CACHE.pop, key, None)
+        while len(_CORE_CACHE) > _CORE_CACHE_SIZE:
+            _CORE_CACHE.popitem(last=False)
+
+    comb_results, key_uniques = cached[1]
+    # the "UNION ALL" pops the columns, keep the cached ones intact
+    return [(n_rows, dict(single_result))
+            for n_rows, single_result in comb_results], key_uniques
 
 
 def cubinggroupby(df,
@@ -65,7 +513,9 @@ def cubinggroupby(df,
                   rollup_cols=None,
                   agg=None,
                   fill_grouping=None,
-                  as_index=True):
+                  as_index=True,
+                  n_jobs=1,
+                  cache=False):
     """
     Group by with CUBE and ROLLUP, then aggregate, in pandas.
 
@@ -91,7 +541,16 @@ def cubinggroupby(df,
         then you can set this parameter as {col_name: 'TOTAL'}.
     as_index: bool, True by default
         Whether the dimensions be the index of the result DataFrame.
-
+    n_jobs: int, 1 by default
+        The number of threads to aggregate and union the grouping sets with.
+        Negative values count from the number of CPUs like in joblib,
+        i.e., -1 means using all the CPUs, -2 all the CPUs but one, etc.
+        0, or fewer than one thread in total, raises ValueError.
+    cache: bool, False by default
+        Whether to reuse the aggregated grouping sets of a previous call
+        on the same df object with the same columns and agg,
+        e.g., when only fill_grouping or as_index changes.
+        The df should not be modified in place between the calls.
 
     Returns
     -------
@@ -112,10 +571,12 @@ def cubinggroupby(df,
         raise ValueError('the columns to be grouped by should be different')
 
     all_groupby_cols = normal_cols + cube_cols + rollup_cols
+    all_groupby_cols_set = frozenset(all_groupby_cols)
 
     # we only limit a few supported agg
     if isinstance(agg, str):
-        value_cols = list(set(df.columns) - set(all_groupby_cols))
+        # keep the order of the columns in df
+        value_cols = [x for x in df.columns if x not in all_groupby_cols_set]
         grouping_func = agg
         agg = {x: grouping_func
                for x in value_cols}  # agg param becomes a dict
@@ -124,63 +585,105 @@ def cubinggroupby(df,
     else:
         raise ValueError('the agg parameter should be only str or dict')
 
-    # the columns that would be in the final result
-    result_cols = all_groupby_cols + value_cols  # for sortting the column index later
-
-    cube_combs = _get_cube_combinations(cube_cols)
-    rollup_combs = _get_rollup_combinations(rollup_cols)
+    if n_jobs is not None and n_jobs < 0:
+        # like joblib, -1 means all the CPUs
+        n_jobs = (os.cpu_count() or 1) + 1 + n_jobs
+    if n_jobs is not None and n_jobs < 1:
+        raise ValueError('the n_jobs parameter should lead to at least '
+                         'one thread')
 
-    comb_result_dfs = []
+    agg = {
+        x: _AGG_ALIASES.get(func, func) if callable(func) else func
+        for x, func in agg.items()
+    }
 
-    for cube_single_comb in cube_combs:
-        for rollup_single_comb in rollup_combs:
-            groupby_cols = normal_cols + list(cube_single_comb) + list(
-                rollup_single_comb)
-            remaining_cols = list(set(all_groupby_cols) - set(groupby_cols))
+    # the columns that would be in the final result
+    result_cols = all_groupby_cols + value_cols  # for sortting the column index later
 
-            #print(groupby_cols)
-            #print(agg)
-            if groupby_cols == []:
-                # special treatment if all dimensions are folded
-                single_result = df.agg(agg).to_frame().T
+    fill_values = {
+        x: _get_grouping_filling(x, fill_grouping)
+        for x in all_groupby_cols
+    }
+    fill_dtypes = {x: df[x].dtype for x in all_groupby_cols}
+
+    def _union_column(x):
+        if x not in all_groupby_cols_set:
+            pieces = [
+                pd.Series(single_result.pop(x))
+                for _, single_result in comb_results
+            ]
+            return pd.concat(pieces, ignore_index=True), None
+
+        fill_dtype = _get_filling_dtype(fill_values[x], fill_dtypes[x])
+
+        if x in key_uniques:
+            # the keys are codes here, and the folded ones are -1
+            codes = np.concatenate([
+                single_result.pop(x) if x in single_result else np.full(
+                    n_rows, -1, dtype=np.int32)
+                for n_rows, single_result in comb_results
+            ])
+            # the values and the filling are directly in the final dtype
+            return (_decode_codes(codes, key_uniques[x], fill_values[x],
+                                  fill_dtype),
+                    _get_sort_codes(codes, key_uniques[x], fill_values[x],
+                                    fill_dtype))
+
+        pieces = []
+        for n_rows, single_result in comb_results:
+            if x in single_result:
+                pieces.append(pd.Series(single_result.pop(x)))
             else:
-                single_result = df.groupby(groupby_cols,
-                                           as_index=False).agg(agg)
-
-            # for all groupby cols,
-            # if they are not in this grouping set,
-            # we should add the columns filled with NULL
-            for single_remaining_col in remaining_cols:
-                dim_value_to_fill = _get_grouping_filling(
-                    single_remaining_col, fill_grouping)
-                #print(dim_value_to_fill)
-                single_result[single_remaining_col] = dim_value_to_fill
-
-                original_dtype = df[single_remaining_col].dtype
-
-                if pd.api.types.is_integer_dtype(
-                        original_dtype) and dim_value_to_fill is None:
-                    # for integer and None, we need special treatment
-                    single_result[single_remaining_col] = pd.to_numeric(
-                        single_result[single_remaining_col])
-                else:
-                    # directly use astype if not integer and not None
-                    single_result[single_remaining_col] = single_result[
-                        single_remaining_col].astype(
-                            df[single_remaining_col].dtype)
-
-            single_result = single_result[result_cols]
-
-            comb_result_dfs.append(single_result)
-
-    # "UNION ALL"
-    unioned_result = pd.concat(
-        comb_result_dfs,
-        ignore_index=True).sort_values(all_groupby_cols).reset_index(drop=True)
+                # for all groupby cols,
+                # if they are not in this grouping set,
+                # we should add the columns filled with NULL
+                pieces.append(
+                    pd.Series(
+                        _get_filled_values(fill_values[x], fill_dtype,
+                                           n_rows)))
+
+        unioned_col = pd.concat(pieces, ignore_index=True)
+        codes, uniques = pd.factorize(unioned_col, sort=True)
+        return unioned_col, np.where(codes < 0, len(uniques), codes)
+
+    executor = None
+    map_func = map
+    if n_jobs is not None and n_jobs != 1:
+        # pandas and numpy release the GIL in most of the work
+        executor = ThreadPoolExecutor(max_workers=n_jobs)
+        map_func = executor.map
+
+    try:
+        if cache:
+            comb_results, key_uniques = _cubinggroupby_core_cached(
+                df, normal_cols, cube_cols, rollup_cols, agg, map_func)
+        else:
+            comb_results, key_uniques = _cubinggroupby_core(
+                df, normal_cols, cube_cols, rollup_cols, agg, map_func)
+
+        # "UNION ALL", column by column, so that the columns of the grouping
+        # sets are released as soon as they are unioned,
+        # instead of holding all the grouping sets and their union at once.
+        # the columns are independent, so they are unioned in parallel too
+        unioned_result = {}
+        sort_codes = {}
+        for x, (unioned_col, col_sort_codes) in zip(
+                result_cols, map_func(_union_column, result_cols)):
+            unioned_result[x] = unioned_col
+            if col_sort_codes is not None:
+                sort_codes[x] = col_sort_codes
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    unioned_result = pd.DataFrame(unioned_result, copy=False)
+
+    # sort only once by the codes, the index would be sorted as well
+    order = np.lexsort([sort_codes[x] for x in reversed(all_groupby_cols)])
+    unioned_result = unioned_result.take(order).reset_index(drop=True)
 
     # make it more like the regular pandas groupby
     if as_index:
-        unioned_result = unioned_result.set_index(
-            all_groupby_cols).sort_index()
+        unioned_result = unioned_result.set_index(all_groupby_cols)
 
     return unioned_result
@@ -1,14 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import gc
+import os
 from io import StringIO
 
 import pandas as pd
 import numpy as np
+import pytest
 
 from cubing_in_pandas import (cubinggroupby, _cols_normalize,
-                              _check_no_interleaving_cols, _get_cube_combinations,
-                              _get_rollup_combinations)
+                              _check_no_interleaving_cols,
+                              _get_cube_combinations, _get_rollup_combinations,
+                              _get_grouping_filling,
+                              _get_group_ids, _get_sort_codes, _decode_codes,
+                              _group_sum, _group_min, _group_max,
+                              _get_unique_pairs, _group_union,
+                              _get_filled_values, _get_filling_dtype,
+                              _CORE_CACHE)
 
 
 def test__cols_normalize():
@@ -24,6 +33,8 @@ def test__check_no_interleaving_cols():
     assert not _check_no_interleaving_cols([1, 2], [1, 4])
     assert not _check_no_interleaving_cols([1, 2], None, [2, 4])
     assert _check_no_interleaving_cols([1, 2], [3, 4], [5, 6])
+    assert not _check_no_interleaving_cols([1, 1])
+    assert not _check_no_interleaving_cols('a', None, 'a')
 
 
 def test__get_cube_combinations():
@@ -43,6 +54,108 @@ def test__get_rollup_combinations():
         [1, 2, 3, 4]) == [tuple(), (1, ), (1, 2), (1, 2, 3), (1, 2, 3, 4)]
 
 
+def test__get_grouping_filling():
+    assert _get_grouping_filling('a') is None
+    assert _get_grouping_filling('a', 'TOTAL') == 'TOTAL'
+    assert _get_grouping_filling('a', {'a': 'TOTAL'}) == 'TOTAL'
+    assert _get_grouping_filling('b', {'a': 'TOTAL'}) is None
+    assert _get_grouping_filling('a', pd.Series({'a': 0})) == 0
+
+
+def test__get_filling_dtype():
+    assert _get_filling_dtype(None, np.dtype('int64')) == np.float64
+    assert _get_filling_dtype(None, pd.Int64Dtype()) == pd.Float64Dtype()
+    assert _get_filling_dtype(0, pd.Int64Dtype()) == pd.Int64Dtype()
+    assert _get_filling_dtype(None, np.dtype(object)) == np.dtype(object)
+
+
+def test__get_group_ids():
+    ids, first, n_groups = _get_group_ids([], 3)
+    assert ids.tolist() == [0, 0, 0]
+    assert n_groups == 1
+
+    key_codes = [(np.array([0, 1, 0, -1, 1]), 2),
+                 (np.array([1, 0, 1, 0, 1]), 2)]
+    ids, first, n_groups = _get_group_ids(key_codes, 5)
+    assert ids.tolist() == [1, 2, 1, 0, 3]
+    assert first.tolist() == [3, 0, 1, 4]
+    assert n_groups == 4
+
+
+def test__group_reducers():
+    ids = np.array([0, 1, 0, 1, 2])
+    ints = np.array([3, 1, 2, 5, 4])
+    floats = np.array([3.0, np.nan, 2.0, 5.0, np.nan])
+
+    assert _group_sum(ids, ints, 3).tolist() == [5, 6, 4]
+    assert _group_sum(ids, ints, 3).dtype == np.int64
+    assert _group_sum(ids, floats, 3).tolist() == [5.0, 5.0, 0.0]
+    assert _group_sum(ids, floats.astype(np.float32),
+                      3).dtype == np.float32
+    assert _group_min(ids, ints, 3).tolist() == [2, 1, 4]
+    assert _group_max(ids, ints, 3).tolist() == [3, 5, 4]
+    np.testing.assert_array_equal(_group_min(ids, floats, 3),
+                                  [2.0, 5.0, np.nan])
+    np.testing.assert_array_equal(_group_max(ids, floats, 3),
+                                  [3.0, 5.0, np.nan])
+
+
+def test__get_sort_codes():
+    uniques = pd.Index(['b', 'c', 'a'])
+    codes = np.array([0, 1, 2, -1])
+    assert _get_sort_codes(codes, uniques, 'd',
+                           object).tolist() == [1, 2, 0, 3]
+    assert _get_sort_codes(codes, uniques, None,
+                           object).tolist() == [1, 2, 0, 3]
+    assert _get_sort_codes(codes, uniques, '0',
+                           object).tolist() == [2, 3, 1, 0]
+
+    # the filling is ranked after being converted to the dtype of the column
+    uniques = pd.Index([5, 1])
+    codes = np.array([0, 1, -1])
+    assert _get_sort_codes(codes, uniques, '0',
+                           np.int64).tolist() == [2, 1, 0]
+    assert _get_sort_codes(codes, uniques, None,
+                           np.float64).tolist() == [1, 0, 2]
+
+
+def test__get_filled_values():
+    values = _get_filled_values(None, np.float64, 2)
+    assert values.dtype == np.float64
+    assert np.isnan(values).all()
+    assert _get_filled_values('TOTAL', object,
+                              2).tolist() == ['TOTAL', 'TOTAL']
+    values = _get_filled_values(None, 'Int64', 2)
+    assert values.dtype == 'Int64'
+    assert values.isna().all()
+
+
+def test__decode_codes():
+    uniques = pd.Index([10, 20])
+    assert _decode_codes(np.array([1, 0]), uniques, None,
+                         np.float64).dtype == np.int64
+    pd.testing.assert_series_equal(
+        _decode_codes(np.array([1, -1, 0]), uniques, None, np.float64),
+        pd.Series([20.0, np.nan, 10.0]))
+    pd.testing.assert_series_equal(
+        _decode_codes(np.array([-1, 0]), pd.Index(['a']), 'TOTAL', object),
+        pd.Series(['TOTAL', 'a'], dtype=object))
+
+
+def test__get_unique_pairs():
+    ids = np.array([0, 1, 0, 1, 0])
+    value_codes = np.array([2, 0, 2, -1, 1])
+    pair_ids, pair_values, n_values = _get_unique_pairs(ids, value_codes, 3)
+    assert pair_ids.tolist() == [0, 0, 1]
+    assert pair_values.tolist() == [1, 2, 0]
+
+    # merge the groups 0 and 1
+    pair_ids, pair_values, n_values = _group_union(
+        np.array([0, 0]), (pair_ids, pair_values, n_values), 1)
+    assert pair_ids.tolist() == [0, 0, 0]
+    assert pair_values.tolist() == [0, 1, 2]
+
+
 def test_cubinggroupby():
     input_text = """category,area,year,product,price
 cat1,area1,1,prod1,10
@@ -124,3 +237,158 @@ cat2,,,4,60
             & pd.isnull(df_cubing_groupby_expected['year'])),
                                        ['product', 'price']].reset_index(
                                            drop=True))
+
+
+def test_cubinggroupby_decomposed_agg():
+    input_text = """category,area,year,price
+cat1,area1,1,10
+cat1,area1,2,11
+cat1,area2,3,12
+cat2,area1,1,13
+cat2,area2,3,
+,area1,4,16
+cat2,,3,18
+"""
+    df = pd.read_csv(StringIO(input_text), sep=',')
+    agg = {'price': 'mean', 'year': 'max'}
+
+    df_cubing_groupby = cubinggroupby(df,
+                                      cube_cols=['category'],
+                                      rollup_cols=['area'],
+                                      agg=agg,
+                                      fill_grouping='TOTAL')
+
+    # every grouping set should be the same as the simple group by
+    for groupby_cols in [['category', 'area'], ['category'], ['area']]:
+        df_normal_groupby = df.groupby(groupby_cols).agg(agg)
+        df_folded = df_cubing_groupby.reset_index()
+        for col in ['category', 'area']:
+            is_folded = df_folded[col] == 'TOTAL'
+            df_folded = df_folded[is_folded == (col not in groupby_cols)]
+        df_folded = df_folded.set_index(groupby_cols)[['price', 'year']]
+        pd.testing.assert_frame_equal(df_folded,
+                                      df_normal_groupby,
+                                      check_dtype=False)
+
+    df_total = df_cubing_groupby.loc[('TOTAL', 'TOTAL')]
+    assert df_total['price'] == df['price'].mean()
+    assert df_total['year'] == 4
+
+    df_cubing_groupby = cubinggroupby(df.astype({'price': np.float32}),
+                                      cube_cols=['category'],
+                                      rollup_cols=['area'],
+                                      agg=agg)
+    assert df_cubing_groupby['price'].dtype == np.float32
+
+
+def test_cubinggroupby_n_jobs():
+    input_text = """category,area,year,product,price
+cat1,area1,1,prod1,10
+cat1,area2,3,prod2,12
+cat2,area1,1,prod1,13
+,area1,4,prod3,16
+cat2,,3,prod4,18
+"""
+    df = pd.read_csv(StringIO(input_text), sep=',')
+    kwargs = dict(cube_cols=['category', 'area'],
+                  rollup_cols=['year'],
+                  agg={
+                      'product': pd.Series.nunique,
+                      'price': 'sum'
+                  },
+                  fill_grouping={'category': 'TOTAL'})
+
+    for n_jobs in [2, -1, -os.cpu_count()]:
+        pd.testing.assert_frame_equal(
+            cubinggroupby(df, n_jobs=n_jobs, **kwargs),
+            cubinggroupby(df, **kwargs))
+
+    for n_jobs in [0, -os.cpu_count() - 1]:
+        with pytest.raises(ValueError):
+            cubinggroupby(df, n_jobs=n_jobs, **kwargs)
+
+
+def test_cubinggroupby_cache():
+    input_text = """category,area,year,product,price
+cat1,area1,1,prod1,10
+cat1,area2,3,prod2,12
+cat2,area1,1,prod1,13
+,area1,4,prod3,16
+cat2,,3,prod4,18
+"""
+    df = pd.read_csv(StringIO(input_text), sep=',')
+
+    for agg in [{'price': 'mean'}, {'product': pd.Series.nunique}]:
+        for fill_grouping in [
+                None, {
+                    'category': 'TOTAL',
+                    'area': 'TOTAL'
+                }, {
+                    'category': 'ALL',
+                    'year': -1
+                }, None
+        ]:
+            kwargs = dict(cube_cols=['category', 'area'],
+                          rollup_cols=['year'],
+                          agg=agg,
+                          fill_grouping=fill_grouping)
+            pd.testing.assert_frame_equal(
+                cubinggroupby(df, cache=True, **kwargs),
+                cubinggroupby(df, **kwargs))
+
+    # the cached results are released along with df
+    assert _CORE_CACHE
+    del df
+    gc.collect()
+    assert not _CORE_CACHE
+
+
+def test_cubinggroupby_non_object_keys():
+    df = pd.DataFrame({
+        'flag': [True, False],
+        'year': [1, 2],
+        'price': [4, 6]
+    })
+
+    # the folded rows are filled with False, and sorted along with False
+    df_cubing_groupby = cubinggroupby(df,
+                                      cube_cols=['flag'],
+                                      agg={'price': 'sum'},
+                                      as_index=False)
+    assert df_cubing_groupby['flag'].tolist() == [False, False, True]
+    assert df_cubing_groupby['price'].tolist() == [10, 6, 4]
+
+    # the folded rows are filled with 0, not '0'
+    df_cubing_groupby = cubinggroupby(df,
+                                      cube_cols=['year'],
+                                      agg={'price': 'sum'},
+                                      fill_grouping={'year': '0'},
+                                      as_index=False)
+    assert df_cubing_groupby['year'].tolist() == [0, 1, 2]
+    assert df_cubing_groupby['price'].tolist() == [10, 4, 6]
+
+    # the nullable integers stay nullable, when filled with None
+    df = df.astype({'year': 'Int64'})
+    for agg in ['sum', 'median']:
+        df_cubing_groupby = cubinggroupby(df,
+                                          cube_cols=['year'],
+                                          agg={'price': agg},
+                                          as_index=False)
+        assert df_cubing_groupby['year'].dtype == pd.Float64Dtype()
+        assert df_cubing_groupby['year'].isna().tolist() == [
+            False, False, True
+        ]
+
+
+def test_cubinggroupby_int_mean():
+    # e.g., the timestamps in ns as integers, the sums would overflow int64
+    df = pd.DataFrame({
+        'a': list('abababab'),
+        'v': np.full(8, 1_700_000_000_000_000_000, dtype=np.int64)
+    })
+
+    df_cubing_groupby = cubinggroupby(df, cube_cols=['a'], agg={'v': 'mean'})
+    pd.testing.assert_series_equal(
+        df_cubing_groupby.loc[['a', 'b'], 'v'],
+        df.groupby('a')['v'].mean())
+    assert df_cubing_groupby.loc[None, 'v'] == df['v'].mean()